@@ -1,2 +1,4 @@
 PDF_TO_TEXT_VERSION = "0.1.0"
 """Version of the PDF to text stage algorithm"""
+CHUNKS_CACHE_VERSION = "0.1.0"
+"""Version of the format of cached document chunks"""
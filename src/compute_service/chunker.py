@@ -20,13 +20,19 @@ class CustomTokenTextSplitter(TextSplitter):
         self.tokenizer = tokenizer
 
     def split_text(self, text: str) -> list[str]:
+        return [split for split, _ in self.split_text_with_token_ids(text)]
+
+    def split_text_with_token_ids(self, text: str) -> list[tuple[str, list[int]]]:
+        """Split text and return chunks along with their token ids (without special tokens)."""
         return split_text_on_tokens(
             text=text, chunk_size=self._chunk_size, chunk_overlap=self._chunk_overlap, tokenizer=self.tokenizer
         )
 
 
-def split_text_on_tokens(*, text: str, chunk_size: int, chunk_overlap: int, tokenizer: BertTokenizerFast):
-    """Split incoming text and return chunks using tokenizer."""
+def split_text_on_tokens(
+    *, text: str, chunk_size: int, chunk_overlap: int, tokenizer: BertTokenizerFast
+) -> list[tuple[str, list[int]]]:
+    """Split incoming text and return chunks with their token ids using tokenizer."""
     splits = []
     tokenization = tokenizer(text, add_special_tokens=False, truncation=False, max_length=VERY_LARGE_INTEGER)
     input_ids = tokenization["input_ids"]
@@ -38,7 +44,7 @@ def split_text_on_tokens(*, text: str, chunk_size: int, chunk_overlap: int, toke
     while start_idx < len(input_ids):
         start, _ = encodings.token_to_chars(start_idx)
         _, end = encodings.token_to_chars(cur_idx - 1)
-        splits.append(text[start:end])
+        splits.append((text[start:end], input_ids[start_idx:cur_idx]))
         if cur_idx == len(input_ids):
             break
         start_idx += chunk_size - chunk_overlap
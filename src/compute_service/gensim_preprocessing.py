@@ -22,6 +22,7 @@ Examples
 
 import re
 import string
+import sys
 import unicodedata
 
 from nltk.corpus import stopwords
@@ -377,6 +378,8 @@ RE_NONALPHA = re.compile(r"\W", re.UNICODE)
 RE_AL_NUM = re.compile(r"([a-z]+)([0-9]+)", flags=re.UNICODE)
 RE_NUM_AL = re.compile(r"([0-9]+)([a-z]+)", flags=re.UNICODE)
 RE_WHITESPACE = re.compile(r"(\s)+", re.UNICODE)
+COMBINING_MARKS = dict.fromkeys(i for i in range(sys.maxunicode + 1) if unicodedata.category(chr(i)) == "Mn")
+"""Translation table deleting all nonspacing marks (accents), see :func:`deaccent`"""
 
 
 def remove_stopwords(s, stopwords=None):
@@ -792,6 +795,8 @@ def deaccent(text):
     if not isinstance(text, str):
         # assume utf8 for byte strings, use default (strict) error handling
         text = text.decode("utf8")
+    if text.isascii():
+        return text
     norm = unicodedata.normalize("NFD", text)
-    result = "".join(ch for ch in norm if unicodedata.category(ch) != "Mn")
+    result = norm.translate(COMBINING_MARKS)
     return unicodedata.normalize("NFC", result)
@@ -1,20 +1,31 @@
+import hashlib
 import itertools
 import logging
+import os
+import pickle
+import queue
+import threading
 import time
-from collections import defaultdict
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from multiprocessing import Pool
+from multiprocessing.pool import Pool as PoolType
 from pathlib import Path
+from typing import TypedDict
 
 import httpx
+import numpy as np
 import pymupdf
 import pymupdf4llm
 from qdrant_client import QdrantClient, models
 from sentence_transformers import SentenceTransformer
+import torch
 from torch import cuda
 
 from src.compute_service.bm25 import Bm25
-from src.compute_service.cache import PDF_TO_TEXT_VERSION
+from src.compute_service.cache import CHUNKS_CACHE_VERSION, PDF_TO_TEXT_VERSION
 from src.compute_service.chunker import CustomTokenTextSplitter
 from src.compute_service.text import clean_text_common, clean_text_for_sparse
 from src.config import settings
@@ -44,12 +55,20 @@ def timeit(key: str, times: int = 1, verbose: str | None = None):
 
 with timeit("init", 1, "BiEncoder, BM25 and ChunkSplitter loading"):
     device = "cuda" if cuda.is_available() else "cpu"
-    bi_encoder = SentenceTransformer(settings.compute_settings.bi_encoder_name, trust_remote_code=True, device=device)
-    bi_encoder.share_memory()
+    # encoding in the main process shares CPU with the workers converting PDFs
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, settings.compute_settings.num_workers)))
+    torch.set_num_interop_threads(2)
+    # the model is moved to the device only in the main process after the worker pool is forked (see `main`),
+    # workers need just the tokenizer for chunking
+    bi_encoder = SentenceTransformer(settings.compute_settings.bi_encoder_name, trust_remote_code=True, device="cpu")
     chunk_splitter = CustomTokenTextSplitter(
         tokenizer=bi_encoder.tokenizer, chunk_size=bi_encoder.max_seq_length, chunk_overlap=25
     )
     bm25 = Bm25()
+    # chunks depend on the text extraction and splitter settings, so cached chunks are invalidated when they change
+    _split_key = f"{PDF_TO_TEXT_VERSION}|{CHUNKS_CACHE_VERSION}|{settings.compute_settings.bi_encoder_name}|"
+    _split_key += f"{chunk_splitter._chunk_size}|{chunk_splitter._chunk_overlap}"
+    CHUNKS_CACHE_DIR = Path("cache") / f"chunks-{hashlib.sha1(_split_key.encode()).hexdigest()[:8]}"
 
 with timeit("qdrant", 1, "Qdrant loading"):
     QDRANT_COLLECTION = settings.compute_settings.qdrant_collection_name
@@ -65,28 +84,56 @@ with timeit("qdrant", 1, "Qdrant loading"):
             sparse_vectors_config={
                 "bm25": models.SparseVectorParams(modifier=models.Modifier.IDF),
             },
+            # build additional HNSW links within the indexed document-ref payload values
+            hnsw_config=models.HnswConfigDiff(payload_m=16),
         )
-        # create indexes
-        qdrant.create_payload_index(
-            QDRANT_COLLECTION, "document-ref.course_id", field_schema=models.PayloadSchemaType.INTEGER
-        )
-        qdrant.create_payload_index(
-            QDRANT_COLLECTION, "document-ref.module_id", field_schema=models.PayloadSchemaType.INTEGER
-        )
-        qdrant.create_payload_index(
-            QDRANT_COLLECTION, "document-ref.filename", field_schema=models.PayloadSchemaType.KEYWORD
-        )
+        # create indexes, without waiting for each of them to be built
+        payload_schema = {
+            "document-ref.course_id": models.PayloadSchemaType.INTEGER,
+            "document-ref.module_id": models.PayloadSchemaType.INTEGER,
+            "document-ref.filename": models.PayloadSchemaType.KEYWORD,
+            "type": models.PayloadSchemaType.KEYWORD,
+            "chunk-ref.chunk_number": models.PayloadSchemaType.INTEGER,
+        }
+        for field_name, field_schema in payload_schema.items():
+            qdrant.create_payload_index(QDRANT_COLLECTION, field_name, field_schema=field_schema, wait=False)
+    # drop chunks indexed by another version of the pipeline, their point IDs differ from the current ones
+    qdrant.delete(
+        QDRANT_COLLECTION,
+        models.FilterSelector(
+            filter=models.Filter(
+                must_not=[models.FieldCondition(key="version", match=models.MatchValue(value=PDF_TO_TEXT_VERSION))]
+            )
+        ),
+        wait=True,
+    )
+
+
+def move_bi_encoder_to_device():
+    if device == "cuda":
+        bi_encoder.to(device)
+        # half precision is enough for dot-product retrieval and doubles encoder throughput
+        bi_encoder.to(torch.bfloat16 if cuda.is_bf16_supported() else torch.float16)
+
+
+def list_moodle_objects() -> list:
+    # List all objects with the "moodle/" prefix recursively
+    return list(minio_client.list_objects(bucket_name=settings.minio.bucket, prefix="moodle/", recursive=True))
 
 
 def fetch_corpora() -> Corpora:
-    with httpx.Client(
-        base_url=f"{settings.compute_settings.api_url}/compute",
-        headers={"Authorization": f"Bearer {settings.compute_settings.auth_token}"},
-    ) as session:
-        response = session.get("/corpora")
-        response.raise_for_status()
-        corpora_data = response.json()
-        corpora = Corpora.model_validate(corpora_data)
+    # both requests are network-bound, so list MinIO objects while waiting for the API
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        objects_future = executor.submit(list_moodle_objects)
+        with httpx.Client(
+            base_url=f"{settings.compute_settings.api_url}/compute",
+            headers={"Authorization": f"Bearer {settings.compute_settings.auth_token}"},
+        ) as session:
+            response = session.get("/corpora")
+            response.raise_for_status()
+            corpora_data = response.json()
+            corpora = Corpora.model_validate(corpora_data)
+        objects = objects_future.result()
 
     as_dict = {
         (entry.course_id, entry.module_id, content.filename): entry
@@ -94,20 +141,24 @@ def fetch_corpora() -> Corpora:
         for content in entry.contents
     }
 
-    # List all objects with the "moodle/" prefix recursively
-    objects = minio_client.list_objects(bucket_name=settings.minio.bucket, prefix="moodle/", recursive=True)
     moodle_files = []
     for obj in objects:
         parts = obj.object_name.split("/")
         course_id, module_id, filename = int(parts[1]), int(parts[2]), parts[3]
-        moodle_object = MoodleFileObject(course_id=course_id, module_id=module_id, filename=filename)
-        entry = as_dict.get((moodle_object.course_id, moodle_object.module_id, moodle_object.filename), None)
+        entry = as_dict.get((course_id, module_id, filename), None)
 
         if entry is not None:
-            moodle_object.course_fullname = entry.course_fullname
-            moodle_object.section_summary = entry.section_summary
-            moodle_object.module_name = entry.module_name
-            moodle_object.module_modname = entry.module_modname
+            moodle_object = MoodleFileObject(
+                course_id=course_id,
+                module_id=module_id,
+                filename=filename,
+                course_fullname=entry.course_fullname,
+                section_summary=entry.section_summary,
+                module_name=entry.module_name,
+                module_modname=entry.module_modname,
+            )
+        else:
+            moodle_object = MoodleFileObject(course_id=course_id, module_id=module_id, filename=filename)
 
         moodle_files.append(moodle_object)
 
@@ -116,130 +167,327 @@ def fetch_corpora() -> Corpora:
     return corpora
 
 
-def moodle_file_to_chunks(obj: MoodleFileObject):
+class FileChunks(TypedDict):
+    """Chunks of one document in a columnar form, Qdrant payloads are built from it only right before uploading."""
+
+    type: str
+    "Type of the document: moodle-file or moodle-entry"
+    ref: dict
+    "Document reference: course_id, module_id and filename"
+    texts: list[str]
+    "Chunk texts, chunk number is the index in the list"
+    input_ids: list[list[int]]
+    "Token ids of the chunks (without special tokens)"
+
+
+def moodle_file_to_chunks(obj: MoodleFileObject) -> FileChunks:
     s3_object_name = content_to_minio_object(obj.course_id, obj.module_id, obj.filename)
 
-    file_path = Path("s3") / s3_object_name
-    if not file_path.exists():
-        minio_client.fget_object(settings.minio.bucket, s3_object_name, str(file_path))
+    chunks_path = CHUNKS_CACHE_DIR / f"{s3_object_name}.pickle"
+    if chunks_path.exists():
+        try:
+            with open(chunks_path, "rb") as f:
+                cached = pickle.load(f)
+            # meta prefix is a part of the text, so chunks are valid only for the same moodle metadata
+            if cached["meta_prefix"] == obj.meta_prefix:
+                return cached["chunks"]
+        except (EOFError, pickle.UnpicklingError, KeyError):
+            logger.warning(f"Broken chunks cache for {obj.filename}, splitting again")
 
     text_path = Path("cache") / f"text-{PDF_TO_TEXT_VERSION}" / s3_object_name
     if not text_path.exists():
+        # PDF is needed only for conversion, so read it into memory instead of storing on disk
+        response = minio_client.get_object(settings.minio.bucket, s3_object_name)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
         with timeit("to_text", 1, f"Converting {obj.filename} to text"):
-            text_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(text_path, "w") as f:
-                doc = pymupdf.Document(file_path)
+            # PyMuPDF is not thread-safe, so documents are converted one per worker process
+            doc = pymupdf.Document(stream=data, filetype="pdf")
+            try:
                 out = pymupdf4llm.process_document(doc, graphics_limit=1000)
-                output = "\n\n".join([chunk["text"] for chunk in out["page_chunks"]])
+            finally:
                 doc.close()
+            output = "\n\n".join([chunk["text"] for chunk in out["page_chunks"]])
+            # write the cache only after a successful conversion and through a temporary file, so neither a failed
+            # conversion nor a crash mid-write leaves a truncated file behind
+            text_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = text_path.with_name(f"{text_path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as f:
                 f.write(output)
+            os.replace(tmp_path, text_path)
     else:
         with open(text_path) as f:
             output = f.read()
-    chunks = []
+    # clean the document separately from the prefix, so the raw text is released before the prefixed copy is built
+    output = clean_text_common(output).lstrip()
+    page_text = clean_text_common(obj.meta_prefix) + output
+    del output
+    splitted = chunk_splitter.split_text_with_token_ids(page_text)
+    chunks = FileChunks(
+        type="moodle-file",
+        ref={"course_id": obj.course_id, "module_id": obj.module_id, "filename": obj.filename},
+        texts=[text for text, _ in splitted],
+        input_ids=[input_ids for _, input_ids in splitted],
+    )
 
-    page_text = clean_text_common(obj.meta_prefix + output)
-    splitted = chunk_splitter.split_text(page_text)
-    for j, text in enumerate(splitted):
-        chunks.append(
-            {
-                "text": text,
-                "type": "moodle-file",
-                "document-ref": {
-                    "course_id": obj.course_id,
-                    "module_id": obj.module_id,
-                    "filename": obj.filename,
-                },
-                "chunk-ref": {
-                    "chunk_number": j,
-                },
-            }
-        )
+    # write to a temporary file first, so a crash doesn't leave a truncated cache behind
+    chunks_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = chunks_path.with_name(f"{chunks_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"meta_prefix": obj.meta_prefix, "chunks": chunks}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, chunks_path)
     return chunks
 
 
-def moodle_entry_to_chunks(entry: MoodleEntrySchema):
+def moodle_entry_to_chunks(entry: MoodleEntrySchema) -> list[FileChunks]:
     chunks = []
     meta_prefix = entry.meta_prefix
     for content in entry.contents:
         text = clean_text_common(meta_prefix + f"{content.filename}")
-        splitted = chunk_splitter.split_text(text)
-        for j, text in enumerate(splitted):
-            chunks.append(
-                {
-                    "text": text,
-                    "type": "moodle-entry",
-                    "document-ref": {
-                        "course_id": entry.course_id,
-                        "module_id": entry.module_id,
-                        "filename": content.filename,
-                    },
-                    "chunk-ref": {
-                        "chunk_number": j,
-                    },
-                }
+        splitted = chunk_splitter.split_text_with_token_ids(text)
+        chunks.append(
+            FileChunks(
+                type="moodle-entry",
+                ref={"course_id": entry.course_id, "module_id": entry.module_id, "filename": content.filename},
+                texts=[text for text, _ in splitted],
+                input_ids=[input_ids for _, input_ids in splitted],
             )
+        )
     return chunks
 
 
-def save_chunks_to_qdrant(chunks: list[dict]):
-    if not chunks:
-        return
+def encode_dense(token_ids: list[list[int]]) -> np.ndarray:
+    """
+    Encode chunks already tokenized by the chunk splitter with the bi-encoder, using length-sorted ("smart") batching.
+
+    Chunks are sorted by token length, so every mini-batch is padded only up to similar lengths, then embeddings are
+    permuted back to the original order.
+    """
+    order = np.argsort([len(ids) for ids in token_ids], kind="stable")
+    tokenizer = bi_encoder.tokenizer
+    max_length = bi_encoder.max_seq_length - tokenizer.num_special_tokens_to_add()
+    batch_size = settings.compute_settings.bi_encoder_batch_size
+    embeddings = []
+    # inference_mode additionally skips autograd bookkeeping compared to no_grad
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            batch = [
+                tokenizer.build_inputs_with_special_tokens(token_ids[i][:max_length])
+                for i in order[start : start + batch_size]
+            ]
+            features = tokenizer.pad({"input_ids": batch}, return_tensors="pt")
+            features = {key: value.to(device) for key, value in features.items()}
+            embeddings.append(bi_encoder(features)["sentence_embedding"].float().cpu().numpy())
+    return np.concatenate(embeddings)[np.argsort(order)]
+
+
+def document_ref_key(ref: dict) -> tuple[int, int, str]:
+    return ref["course_id"], ref["module_id"], ref["filename"]
+
+
+def fetch_existing_chunk_counts() -> Counter[tuple[str, int, int, str]]:
+    """Count chunks already stored in Qdrant per (type, *document ref) with a single scroll over the collection."""
+    counts = Counter()
+    offset = None
+    while True:
+        points, offset = qdrant.scroll(
+            QDRANT_COLLECTION, limit=10_000, offset=offset, with_payload=["document-ref", "type"], with_vectors=False
+        )
+        for point in points:
+            counts[(point.payload["type"], *document_ref_key(point.payload["document-ref"]))] += 1
+        if offset is None:
+            break
+    return counts
 
-    ref = chunks[0]["document-ref"]
-    must = [
-        models.FieldCondition(key=f"document-ref.{key}", match=models.MatchValue(value=value))
-        for key, value in ref.items()
-    ]
-    duplicates_filter = models.Filter(must=must)
 
-    exact_match = qdrant.count(QDRANT_COLLECTION, count_filter=duplicates_filter).count
-    if exact_match == len(chunks):
-        logger.info(f"Skipping {len(chunks)} chunks as they are already in Qdrant")
-        return
+def encode_sparse(texts: list[str]) -> list[models.SparseVector]:
+    with timeit("sparse", len(texts), None):
+        return list(bm25.embed(map(clean_text_for_sparse, texts)))
 
-    qdrant.delete(QDRANT_COLLECTION, models.FilterSelector(filter=duplicates_filter), wait=True)
-    texts = [chunk["text"] for chunk in chunks]
-    with timeit("dense", len(texts), None):
-        dense_vectors = bi_encoder.encode(
-            texts,
-            show_progress_bar=False,
-            batch_size=settings.compute_settings.bi_encoder_batch_size,
-        )
 
-    with timeit("sparse", len(texts), None):
-        sparse_vectors = list(bm25.embed(map(clean_text_for_sparse, texts)))
+def encode_chunks(file_chunks: list[FileChunks]) -> list[dict]:
+    texts = [text for chunks in file_chunks for text in chunks["texts"]]
+    token_ids = [ids for chunks in file_chunks for ids in chunks["input_ids"]]
+    # sparse encoding is pure python, so it overlaps with dense encoding while torch kernels release the GIL
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        sparse_future = executor.submit(encode_sparse, texts)
+        with timeit("dense", len(texts), None):
+            dense_vectors = encode_dense(token_ids)
+        sparse_vectors = sparse_future.result()
 
     vectors = []
     for dense_vector, sparse_vector in zip(dense_vectors, sparse_vectors):
-        vectors.append({"dense": dense_vector, "bm25": sparse_vector})
+        vectors.append({"dense": dense_vector.tolist(), "bm25": sparse_vector})
+    return vectors
+
+
+def point_id(type_: str, ref: dict, chunk_number: int) -> str:
+    """Deterministic point ID, so re-uploading the same chunk overwrites it instead of creating a duplicate."""
+    course_id, module_id, filename = document_ref_key(ref)
+    name = f"{type_}:{course_id}:{module_id}:{filename}:{chunk_number}:{PDF_TO_TEXT_VERSION}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+def delete_stale_chunks(file_chunks: list[FileChunks]):
+    """
+    Delete points of the documents that won't be overwritten by the new upload: chunks of another type under the same
+    document ref, and chunks left over after the document got shorter.
+    """
+    should = []
+    for chunks in file_chunks:
+        course_id, module_id, filename = document_ref_key(chunks["ref"])
+        same_type = models.FieldCondition(key="type", match=models.MatchValue(value=chunks["type"]))
+        should.append(
+            models.Filter(
+                must=[
+                    models.FieldCondition(key="document-ref.course_id", match=models.MatchValue(value=course_id)),
+                    models.FieldCondition(key="document-ref.module_id", match=models.MatchValue(value=module_id)),
+                    models.FieldCondition(key="document-ref.filename", match=models.MatchValue(value=filename)),
+                    models.Filter(
+                        should=[
+                            models.Filter(must_not=[same_type]),
+                            models.FieldCondition(
+                                key="chunk-ref.chunk_number", range=models.Range(gte=len(chunks["texts"]))
+                            ),
+                        ]
+                    ),
+                ]
+            )
+        )
+    qdrant.delete(QDRANT_COLLECTION, models.FilterSelector(filter=models.Filter(should=should)), wait=False)
+
+
+def save_chunks_to_qdrant(file_chunks: list[FileChunks], vectors: list[dict]):
+    if not file_chunks:
+        return
+
+    points = []
+    vectors_iter = iter(vectors)
+    for chunks in file_chunks:
+        for j, text in enumerate(chunks["texts"]):
+            payload = {
+                "text": text,
+                "type": chunks["type"],
+                "document-ref": chunks["ref"],
+                "chunk-ref": {"chunk_number": j},
+                "version": PDF_TO_TEXT_VERSION,
+            }
+            points.append(
+                models.PointStruct(
+                    id=point_id(chunks["type"], chunks["ref"], j), vector=next(vectors_iter), payload=payload
+                )
+            )
+    # keep chunks of the same document next to each other for better locality in Qdrant storage
+    points.sort(key=lambda p: (*document_ref_key(p.payload["document-ref"]), p.payload["chunk-ref"]["chunk_number"]))
+    with timeit("upload", len(points), None):
+        qdrant.upload_points(
+            QDRANT_COLLECTION,
+            points=points,
+            batch_size=256,
+            # upload already overlaps with encoding in a background thread, extra processes would be forked per call
+            parallel=1,
+            max_retries=3,
+            wait=False,
+        )
+    # stale points never share IDs with the new ones, they are deleted only after a successful upload, so a failed
+    # upload leaves the document with mismatching counts and it is uploaded again on the next pass
+    delete_stale_chunks(file_chunks)
+    logger.info(f"Saved +{len(points)} chunks to Qdrant")
+
 
-    qdrant.upload_collection(QDRANT_COLLECTION, payload=chunks, vectors=vectors)
-    logger.info(f"Saved +{len(chunks)} chunks to Qdrant")
+def qdrant_uploader(upload_queue: queue.Queue, errors: list[Exception]):
+    """
+    Upload encoded batches from the queue until `None` is received. Errors are collected into `errors` and the queue
+    is drained further, so the producer never blocks on a full queue.
+    """
+    while (batch := upload_queue.get()) is not None:
+        try:
+            save_chunks_to_qdrant(*batch)
+        except Exception as e:
+            logger.exception("Failed to save chunks to Qdrant")
+            errors.append(e)
 
 
-def corpora_to_qdrant(corpora: Corpora):
+def pool_chunksize(n_items: int) -> int:
+    """Send items to workers in groups to reduce IPC overhead, while keeping enough groups for load balancing."""
+    return min(32, max(1, n_items // (settings.compute_settings.num_workers * 4)))
+
+
+def corpora_to_qdrant(corpora: Corpora, pool: PoolType):
     logger.info(f"Processing {len(corpora.moodle_files)} items")
     collection_len = 0
+    skipped_len = 0
     pdf_files = [item for item in corpora.moodle_files if item.filename.endswith(".pdf")]
     _pdf_files = {(item.course_id, item.module_id, item.filename) for item in pdf_files}
     moodle_entries_but_not_pdf = []
     for moodle_entry in corpora.moodle_entries:
-        for content in moodle_entry.contents:
-            if (moodle_entry.course_id, moodle_entry.module_id, content.filename) not in _pdf_files:
-                moodle_entries_but_not_pdf.append(moodle_entry)
-                break
+        # pdf contents are indexed as moodle files, keep only the rest so the document refs don't collide
+        contents = [
+            content
+            for content in moodle_entry.contents
+            if (moodle_entry.course_id, moodle_entry.module_id, content.filename) not in _pdf_files
+        ]
+        if contents:
+            moodle_entries_but_not_pdf.append(moodle_entry.model_copy(update={"contents": contents}))
 
     with timeit("corpora", len(pdf_files) + len(moodle_entries_but_not_pdf), "Processing corpora"):
-        with Pool(processes=settings.compute_settings.num_workers) as pool:
-            file_chunks = pool.imap_unordered(moodle_file_to_chunks, pdf_files)
-            entry_chunks = pool.imap_unordered(moodle_entry_to_chunks, moodle_entries_but_not_pdf)
-
-            for chunks in itertools.chain(entry_chunks, file_chunks):
-                if chunks:
-                    save_chunks_to_qdrant(chunks)
-                    collection_len += len(chunks)
-        logger.info(f"Processed {collection_len} chunks")
+        with timeit("existing", 1, None):
+            existing_counts = fetch_existing_chunk_counts()
+            ref_counts = Counter()
+            for (_, *ref), count in existing_counts.items():
+                ref_counts[tuple(ref)] += count
+
+        # workers only extract and split text, encoding happens here in the main process, uploading in the background
+        upload_queue = queue.Queue(maxsize=16)
+        upload_errors = []
+        uploader = threading.Thread(target=qdrant_uploader, args=(upload_queue, upload_errors), daemon=True)
+        uploader.start()
+        try:
+            file_chunks = pool.imap_unordered(moodle_file_to_chunks, pdf_files, pool_chunksize(len(pdf_files)))
+            entry_chunks = pool.imap_unordered(
+                moodle_entry_to_chunks, moodle_entries_but_not_pdf, pool_chunksize(len(moodle_entries_but_not_pdf))
+            )
+
+            pending = []
+            pending_len = 0
+            # each entry produces chunks for every of its contents
+            for chunks in itertools.chain(itertools.chain.from_iterable(entry_chunks), file_chunks):
+                n_chunks = len(chunks["texts"])
+                if not n_chunks:
+                    continue
+                ref = document_ref_key(chunks["ref"])
+                key = (chunks["type"], *ref)
+                # up to date only if nothing else is stored under the same document ref
+                if existing_counts[key] == n_chunks and ref_counts[ref] == n_chunks:
+                    skipped_len += n_chunks
+                    continue
+                # stale chunks are deleted right after the upload, see `delete_stale_chunks`
+                existing_counts[key] = ref_counts[ref] = n_chunks
+                pending.append(chunks)
+                pending_len += n_chunks
+
+                if pending_len >= settings.compute_settings.qdrant_upload_batch_size:
+                    # stop early instead of encoding batches that can't be uploaded anyway
+                    if upload_errors:
+                        break
+                    upload_queue.put((pending, encode_chunks(pending)))
+                    collection_len += pending_len
+                    pending = []
+                    pending_len = 0
+
+            if pending and not upload_errors:
+                upload_queue.put((pending, encode_chunks(pending)))
+                collection_len += pending_len
+        finally:
+            upload_queue.put(None)
+            uploader.join()
+        if upload_errors:
+            raise upload_errors[0]
+        logger.info(f"Processed {collection_len} chunks, skipped {skipped_len} chunks already in Qdrant")
         _ = "\n"
         for key, (spent, count) in _timeit.items():
             _ += f"{key}: {spent:.2f} seconds ({count} times)\n"
@@ -247,32 +495,43 @@ def corpora_to_qdrant(corpora: Corpora):
         logger.info(_)
 
 
-def no_corpora_changes(prev_corpora: Corpora | None, corpora: Corpora) -> bool:
-    if prev_corpora is None:
-        return False
-    prev_moodle_files = prev_corpora.moodle_files
-    corpora_moodle_files = corpora.moodle_files
-
-    _prev = [_.model_dump() for _ in prev_moodle_files]
-    _curr = [_.model_dump() for _ in corpora_moodle_files]
-    return _prev == _curr
+def corpora_fingerprint(corpora: Corpora) -> bytes:
+    """Stable hash of the moodle files in the corpora, used to detect changes between polls."""
+    h = hashlib.blake2b(digest_size=16)
+    for f in sorted(corpora.moodle_files, key=lambda f: (f.course_id, f.module_id, f.filename)):
+        fields = (
+            f.course_id,
+            f.module_id,
+            f.filename,
+            f.course_fullname,
+            f.section_summary,
+            f.module_name,
+            f.module_modname,
+        )
+        h.update("\x1f".join(map(str, fields)).encode())
+        h.update(b"\x1e")
+    return h.digest()
 
 
 def main():
     logger.info(f"Fetch corpora every {settings.compute_settings.corpora_update_period} seconds")
-    prev_corpora = None
-    while True:
-        corpora = fetch_corpora()
-
-        if no_corpora_changes(prev_corpora, corpora):
-            logger.info("No corpora changes")
-        else:
-            logger.info(f"Populated by {len(corpora.moodle_files)} corpora entries")
-            corpora_to_qdrant(corpora)
-            prev_corpora = corpora
-
-        # Wait for the specified period before fetching tasks again
-        time.sleep(settings.compute_settings.corpora_update_period)
+    prev_fingerprint = None
+    # persistent workers are forked before the model is moved to GPU, so they never inherit a CUDA context
+    with Pool(processes=settings.compute_settings.num_workers) as pool:
+        move_bi_encoder_to_device()
+        while True:
+            corpora = fetch_corpora()
+
+            fingerprint = corpora_fingerprint(corpora)
+            if fingerprint == prev_fingerprint:
+                logger.info("No corpora changes")
+            else:
+                logger.info(f"Populated by {len(corpora.moodle_files)} corpora entries")
+                corpora_to_qdrant(corpora, pool)
+                prev_fingerprint = fingerprint
+
+            # Wait for the specified period before fetching tasks again
+            time.sleep(settings.compute_settings.corpora_update_period)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,7 @@ import numpy as np
 from qdrant_client import QdrantClient, models
 from qdrant_client.models import ScoredPoint
 from sentence_transformers import SentenceTransformer, CrossEncoder
+import torch
 from torch import cuda
 
 from src.compute_service.bm25 import Bm25
@@ -31,7 +32,11 @@ with timeit("BiEncoder, BM25 and CrossEncoder loading"):
     device = "cuda" if cuda.is_available() else "cpu"
     bi_encoder = SentenceTransformer(settings.compute_settings.bi_encoder_name, trust_remote_code=True, device=device)
     cross_encoder = CrossEncoder(settings.compute_settings.cross_encoder_name, trust_remote_code=True, device=device)
-    bi_encoder.share_memory()
+    if device == "cuda":
+        # keep the same precision as used for indexing in prepare.py
+        bi_encoder.to(torch.bfloat16 if cuda.is_bf16_supported() else torch.float16)
+    else:
+        bi_encoder.share_memory()
     bm25 = Bm25()
 
     logger.info(f"Device: {device}")
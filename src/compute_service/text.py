@@ -10,24 +10,22 @@ from src.compute_service.gensim_preprocessing import (
 )
 
 
+COMMON_FILTERS = [strip_tags, strip_multiple_whitespaces]
+SPARSE_FILTERS = [
+    str.lower,
+    strip_tags,
+    strip_punctuation,
+    strip_multiple_whitespaces,
+    deaccent,
+    strip_numeric,
+    remove_stopwords,
+    strip_short,
+]
+
+
 def clean_text_common(text):
-    return preprocess_string(
-        text,
-        filters=[strip_tags, strip_multiple_whitespaces],
-    )
+    return preprocess_string(text, filters=COMMON_FILTERS)
 
 
 def clean_text_for_sparse(text):
-    return preprocess_string(
-        text,
-        filters=[
-            lambda x: x.lower(),
-            strip_tags,
-            strip_punctuation,
-            strip_multiple_whitespaces,
-            deaccent,
-            strip_numeric,
-            remove_stopwords,
-            strip_short,
-        ],
-    )
+    return preprocess_string(text, filters=SPARSE_FILTERS)
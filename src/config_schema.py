@@ -58,6 +58,8 @@ class ComputeSetting(CustomModel):
     "Name of the bi-encoder model"
     bi_encoder_batch_size: int = 32
     "Batch size for the bi-encoder model"
+    qdrant_upload_batch_size: int = 1024
+    "Number of chunks to accumulate across files before encoding and uploading them to Qdrant at once"
     cross_encoder_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
     "Name of the cross-encoder model"
     cross_encoder_batch_size: int = 32
@@ -1,7 +1,11 @@
+from pydantic import ConfigDict
+
 from src.custom_pydantic import CustomModel
 
 
 class MoodleFileObject(CustomModel):
+    model_config = ConfigDict(frozen=True)
+
     course_id: int
     module_id: int
     filename: str